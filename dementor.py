@@ -8,13 +8,147 @@ from keras.layers import Embedding
 from keras.layers import Concatenate
 from keras.models import load_model
 
+import hashlib
+import numpy as np
+import os
+import pickle
+
+
+class ClosingsEncoder:
+    """
+    Shared encoder turning the closings of an exercise into a compact embedding.
+    It's trained for every user at once so per-user models only need a small head over the cached embeddings.
+    The trending of the exercise is already an input of the heads, so the encoder
+    doesn't learn it, instead, it learns to predict how the closings move (see ClosingsEncoder.targets)
+    """
+
+    def __init__(self, model_path=None, closings_shape=1000, embedding_shape=32):
+        if model_path:
+            self.model = load_model(model_path)
+            self.encoder = Model(self.model.input, self.model.get_layer(
+                "closings_embedding").output)
+            return
+
+        targets = 3  # volatility, range, recent return
+
+        closings_input = Input(closings_shape)
+        closings_dense = Dense(64)(closings_input)
+        closings_relu = LeakyReLU(alpha=0.2)(closings_dense)
+        closings_dropout = Dropout(rate=0.3)(closings_relu)
+
+        closings_dense = Dense(128)(closings_dropout)
+        closings_relu = LeakyReLU(alpha=0.2)(closings_dense)
+        closings_dropout = Dropout(rate=0.3)(closings_relu)
+
+        closings_embedding = Dense(
+            embedding_shape, name="closings_embedding")(closings_dropout)
+        closings_relu = LeakyReLU(alpha=0.2)(closings_embedding)
+
+        output = Dense(targets)(closings_relu)
+        model = Model(closings_input, output)
+        model.compile(loss="mean_squared_error", optimizer="adam")
+
+        self.model = model
+        self.encoder = Model(closings_input, closings_embedding)
+
+    @staticmethod
+    def normalize(closings):
+        """
+        Closings (in logarithmic scale) relative to the first closing of every exercise,
+        this way, embeddings don't depend on the magnitude of the prices of every cryptocurrency
+        """
+        closings = np.asarray(closings, dtype=float).reshape(len(closings), -1)
+        return np.log(closings / closings[:, :1])
+
+    @staticmethod
+    def targets(closings):
+        """
+        What the encoder learns to predict of every exercise (standarized across exercises), that is:
+        - volatility: standard deviation of the logarithmic returns
+        - range: logarithmic distance between the highest and the lowest closing
+        - recent return: logarithmic return over the last tenth of the closings
+        """
+        log_closings = ClosingsEncoder.normalize(closings)
+        log_returns = np.diff(log_closings, axis=1)
+        recent_closings = max(log_closings.shape[1] // 10, 1)
+
+        targets = np.stack([
+            log_returns.std(axis=1),
+            log_closings.max(axis=1) - log_closings.min(axis=1),
+            log_closings[:, -1] - log_closings[:, -recent_closings - 1]], axis=1)
+
+        targets_standard_deviation = targets.std(axis=0)
+        targets_standard_deviation[targets_standard_deviation == 0] = 1
+        return (targets - targets.mean(axis=0)) / targets_standard_deviation
+
+    def train(self, closings, epochs=10, batch_size=32):
+        history = self.model.fit(ClosingsEncoder.normalize(closings), ClosingsEncoder.targets(closings),
+                                 epochs=epochs, batch_size=batch_size, verbose=0)
+        return history.history
+
+    def encode(self, closings):
+        return self.encoder.predict(ClosingsEncoder.normalize(closings), verbose=0)
+
+    def embedding_shape(self):
+        return self.encoder.output_shape[-1]
+
+    def fingerprint(self):
+        """
+        Identifies the encoder weights, this way, embeddings (and models trained over them)
+        can be told apart between different trainings of the encoder
+        """
+        fingerprint = hashlib.sha1()
+        for weights in self.encoder.get_weights():
+            fingerprint.update(weights.tobytes())
+        return fingerprint.hexdigest()
+
+    def embeddings(self, closings, cache_path):
+        """
+        Retrieves the embeddings of every exercise, where the row i is the embedding of the exercise_hash i.
+        Embeddings are cached in cache_path and only computed again
+        when either the exercises or the encoder weights change
+        """
+        fingerprint = hashlib.sha1(closings.tobytes())
+        fingerprint.update(self.fingerprint().encode())
+        fingerprint = fingerprint.hexdigest()
+
+        try:
+            with open(cache_path, "rb") as f:
+                cache = pickle.load(f)
+            if cache["fingerprint"] == fingerprint:
+                return cache["embeddings"]
+        except FileNotFoundError:
+            # first execution time should throw this error
+            # so we skip it because we haven't cached any embedding yet
+            pass
+        except (EOFError, pickle.UnpicklingError, KeyError, TypeError):
+            # the cache is truncated or has an unknown format,
+            # so we compute the embeddings again (overwriting it)
+            pass
+
+        embeddings = np.asarray(self.encode(closings))
+
+        os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+        with open(cache_path, "wb") as f:
+            pickle.dump({"fingerprint": fingerprint,
+                        "embeddings": embeddings}, f)
+
+        return embeddings
+
+    def save_model(self, name="encoder"):
+        self.model.save(f"models/{name}.h5", include_optimizer=True)
+
 
 class Dementor:
-    def __init__(self, model_path=None):
+    def __init__(self, model_path=None, embedding_shape=None):
         if model_path:
             self.model = load_model(model_path)
             return
 
+        if embedding_shape:
+            self.model = Dementor.head(embedding_shape)
+            return
+
         closings_shape = 1000
         tendence_shape = 500
         user_choices = 3  # downward, range, upward
@@ -58,6 +192,41 @@ class Dementor:
 
         self.model = model
 
+    @staticmethod
+    def head(embedding_shape):
+        """
+        Lightweight per-user model over the embeddings given by ClosingsEncoder
+        (instead of learning its own closings layers)
+        """
+        tendence_shape = 16
+        user_choices = 3  # downward, range, upward
+
+        decisions_input = Input(1)
+        decisions_embedding = Embedding(
+            input_dim=user_choices, output_dim=tendence_shape)(decisions_input)
+        decisions_flatten = Flatten()(decisions_embedding)
+
+        closings_embedding_input = Input(embedding_shape)
+
+        decisions_closings_concatenation = Concatenate(
+            axis=1)([decisions_flatten, closings_embedding_input])
+        decisions_closings_dense = Dense(32)(decisions_closings_concatenation)
+        decisions_closings_relu = LeakyReLU(
+            alpha=0.2)(decisions_closings_dense)
+        decisions_closings_dropout = Dropout(rate=0.2)(decisions_closings_relu)
+
+        output = Dense(user_choices, activation="softmax")(
+            decisions_closings_dropout)
+        model = Model([decisions_input, closings_embedding_input], output)
+        model.compile(loss="categorical_crossentropy",
+                      optimizer="adam", metrics=["accuracy"])
+
+        return model
+
+    def fit(self, inputs, outputs, epochs=10):
+        history = self.model.fit(inputs, outputs, epochs=epochs, verbose=0)
+        return history.history
+
     def train_on_batch(self, inputs, outputs):
         metrics = self.model.train_on_batch(inputs, outputs, return_dict=True)
         return metrics
@@ -108,3 +108,29 @@ class BinanceMaxCandlesError(Exception):
         """
         super().__init__(
             f"Binance can only retrieve {BinanceMaxCandlesError.max_candles_to_retrieve} candles, but you provided {candles_provided} which is greater")
+
+
+class CandlesGapError(Exception):
+    """
+    Raises when there are missing candles ("holes") between the candles retrieved from Binance
+    """
+
+    def __init__(self, candles_size: str, symbol: str, gaps_timestamps: list, missing_candles: list):
+        """
+        Parameters
+        ----------
+        candles_size: str
+            The size of the candles, either, 15m, 30m or 1h, for instance
+        symbol: str
+            The name of the cryptocurrency
+        gaps_timestamps: list
+            The timestamps (in milliseconds) of the candles placed right before every hole
+        missing_candles: list
+            The number of missing candles of every hole
+        """
+        self.gaps_timestamps = gaps_timestamps
+        self.missing_candles = missing_candles
+        gaps = ", ".join(f"{missing} after {pandas.Timestamp(timestamp, unit='ms')}" for timestamp,
+                         missing in zip(gaps_timestamps, missing_candles))
+        super().__init__(
+            f"Binance has missing candles of size {candles_size} for {symbol}: {gaps}")
@@ -3,7 +3,8 @@ import numpy as np
 import torch
 import pickle
 from sklearn.linear_model import LinearRegression
-from error import BinanceMaxCandlesError, BeforeOperationError, NotEnoughCandlesError, NotEnoughCandlesFromBinanceError
+from numpy.lib.recfunctions import structured_to_unstructured
+from error import BinanceMaxCandlesError, BeforeOperationError, NotEnoughCandlesError, NotEnoughCandlesFromBinanceError, CandlesGapError
 import cryptocurrencies_setup
 import binance_client_setup
 from utils import flush
@@ -23,7 +24,113 @@ from utils import flush
 converter = {"15m": 1/4 * 60, "1h": 1 * 60, "4h": 4 * 60}
 
 
-def get_candles(symbol: str, start: pd.Timestamp, candles_amount: int, candles_size: str):
+# layout of the candles retrieved from Binance API
+# every kline is parsed straight into this structured type,
+# this way, timestamps keep being integers (milliseconds)
+# and prices and volumes are floats (instead of the strings Binance sends)
+# the order of the fields matches the order of the kline sent by Binance
+kline_dtype = np.dtype([("timestamp", np.int64), ("open", np.float64), ("high", np.float64),
+                        ("low", np.float64), ("close", np.float64), ("volume", np.float64)])
+
+# the ways to treat the holes found in the candles retrieved from Binance API
+# - "raise": raises error.CandlesGapError (the exercise is discarded)
+# - "fill": inserts the missing candles repeating the last known closing with no volume
+# - "skip": ignores the missing candles and keeps retrieving until having enough candles
+gaps_policies = ("raise", "fill", "skip")
+
+
+def find_gaps(timestamps: np.array, candles_size: str):
+    """
+    Finds the holes between consecutive candles using the deltas of their timestamps
+
+    Parameters
+    ----------
+    timestamps: numpy.array
+        1D array with the opening timestamps (in milliseconds) of the candles
+    candles_size: str
+        The size of the candles, either, 15m, 1h or 4h
+
+    Returns
+    -------
+    numpy.array
+        1D array with the indexes of the candles placed right after every hole
+    numpy.array
+        1D array with the number of missing candles of every hole
+
+    Examples
+    --------
+    >>> find_gaps(np.arange(5) * 900000, "15m")
+    (array([], dtype=int64), array([], dtype=int64))
+    >>> find_gaps(np.array([0, 1, 2, 5, 6]) * 900000, "15m")
+    (array([3]), array([2]))
+
+    a hole between two pages (of 1000 candles) of Binance API
+
+    >>> find_gaps(np.concatenate([np.arange(1000), np.arange(1003, 1010)]) * 900000, "15m")
+    (array([1000]), array([3]))
+    """
+    candle_milliseconds = int(converter[candles_size] * 60 * 1000)
+    missing_candles = np.diff(timestamps) // candle_milliseconds - 1
+    positions = np.flatnonzero(missing_candles > 0)
+
+    return positions + 1, missing_candles[positions]
+
+
+def fill_gaps(bars: np.array, candles_size: str, candles_amount: int):
+    """
+    Builds a contiguous series of candles where missing candles repeat the last known closing with no volume
+
+    Parameters
+    ----------
+    bars: numpy.array
+        1D structured array (see kline_dtype) with the retrieved candles
+    candles_size: str
+        The size of the candles, either, 15m, 1h or 4h
+    candles_amount: int
+        Amount of candles of the contiguous series (candles beyond it are dropped)
+
+    Examples
+    --------
+    >>> bars = np.zeros(4, dtype=kline_dtype)
+    >>> bars["timestamp"] = np.array([0, 1, 3, 4]) * 900000
+    >>> bars["close"] = [1, 2, 4, 5]
+    >>> bars["volume"] = 1
+    >>> filled = fill_gaps(bars, "15m", 4)
+    >>> filled["timestamp"] // 900000
+    array([0, 1, 2, 3])
+    >>> filled["close"]
+    array([1., 2., 2., 4.])
+    >>> filled["volume"]
+    array([1., 1., 0., 1.])
+    """
+    candle_milliseconds = int(converter[candles_size] * 60 * 1000)
+
+    # every candle is placed in the slot given by its distance to the first candle
+    slots = (bars["timestamp"] - bars["timestamp"][0]) // candle_milliseconds
+    in_range = slots < candles_amount
+
+    filled = np.zeros(candles_amount, dtype=kline_dtype)
+    filled[slots[in_range]] = bars[in_range]
+
+    # for every slot, we look for the last slot having a retrieved candle
+    # (the first slot always has one) and we forward its closing to the missing ones
+    present = np.zeros(candles_amount, dtype=bool)
+    present[slots[in_range]] = True
+    last_present = np.maximum.accumulate(
+        np.where(present, np.arange(candles_amount), 0))
+    missing = ~present
+    last_closings = filled["close"][last_present[missing]]
+
+    filled["timestamp"] = bars["timestamp"][0] + \
+        np.arange(candles_amount, dtype=np.int64) * candle_milliseconds
+    for field in ("open", "high", "low", "close"):
+        filled[field][missing] = last_closings
+    filled["volume"][missing] = 0
+
+    return filled
+
+
+def get_candles(symbol: str, start: pd.Timestamp, candles_amount: int, candles_size: str, gaps: str = "raise"):
     """
     Retrieves candles of a cryptocurrency pair from Binance API
 
@@ -37,6 +144,13 @@ def get_candles(symbol: str, start: pd.Timestamp, candles_amount: int, candles_s
         Amount of candles to retrieve
     candles_size: str
         The size of the candles to retrieve, either, 15m, 30m, and so on.
+    gaps: str
+        How to treat missing candles, either, "raise", "fill" or "skip" (see gaps_policies)
+
+    Returns
+    -------
+    numpy.array
+        1D structured array (see kline_dtype) with candles_amount candles
 
     Raises
     ------
@@ -46,10 +160,16 @@ def get_candles(symbol: str, start: pd.Timestamp, candles_amount: int, candles_s
         If the combination of starting datetime to retrieve candles and the candle size itself doesn't allow to retrieve the indicated number of candles
     error.NotEnoughCandlesFromBinanceError
         If retrieved candles from Binance API are less than expected (even having the right arguments)
+    error.CandlesGapError
+        If there are missing candles between the retrieved ones and gaps is "raise"
     """
     # if candles_amount > BinanceMaxCandlesError.max_candles_to_retrieve:
     #     raise BinanceMaxCandlesError(candles_amount)
 
+    if gaps not in gaps_policies:
+        raise ValueError(
+            f"gaps must be one of {gaps_policies}, but you provided {gaps}")
+
     today = pd.Timestamp.today()
     symbol_beginning = cryptocurrencies_setup.beginnings[symbol]
 
@@ -65,25 +185,62 @@ def get_candles(symbol: str, start: pd.Timestamp, candles_amount: int, candles_s
         raise NotEnoughCandlesError(
             symbol=symbol, candles_size=candles_size, start=start)
 
-    candles_left = candles_amount
-    bars = np.empty((0, 12), float)
-
-    while candles_left:
-        candles_to_retrieve = candles_left
+    # candles are written in place into a preallocated array
+    # instead of growing (and copying) an array on every request
+    bars = np.empty(candles_amount, dtype=kline_dtype)
+    candles_retrieved = 0
+    candle_milliseconds = int(converter[candles_size] * 60 * 1000)
+    start_time = int(start.timestamp() * 1000)
 
-        if candles_left > BinanceMaxCandlesError.max_candles_to_retrieve:
-            candles_to_retrieve = BinanceMaxCandlesError.max_candles_to_retrieve
+    while candles_retrieved < candles_amount:
+        candles_to_retrieve = min(
+            candles_amount - candles_retrieved, BinanceMaxCandlesError.max_candles_to_retrieve)
 
         retrieved_bars = binance_client_setup.client.get_klines(
-            symbol=symbol, interval=candles_size, startTime=int(start.timestamp()), limit=candles_to_retrieve)
-        bars = np.append(bars, retrieved_bars, axis=0)
-        candles_left -= candles_to_retrieve
+            symbol=symbol, interval=candles_size, startTime=start_time, limit=candles_to_retrieve)
 
-    if len(bars) < candles_amount:
+        # Binance doesn't have more candles to give
+        if not retrieved_bars:
+            break
+
+        # every kline is [timestamp, open, high, low, close, volume, ...]
+        # where prices and volume are strings, so numpy parses them
+        # while writing them into their fields
+        retrieved_amount = len(retrieved_bars)
+        bars[candles_retrieved:candles_retrieved + retrieved_amount] = [
+            tuple(bar[:6]) for bar in retrieved_bars]
+        candles_retrieved += retrieved_amount
+
+        # next request starts right after the last retrieved candle
+        start_time = int(bars["timestamp"][candles_retrieved - 1]) + \
+            candle_milliseconds
+
+    if candles_retrieved < candles_amount:
         raise NotEnoughCandlesFromBinanceError(
             candles_size=candles_size, symbol=symbol)
 
-    return bars.tolist()
+    # positions are the candles right after every hole
+    # so the holes begin after the previous candles
+    positions, missing_candles = find_gaps(bars["timestamp"], candles_size)
+
+    if len(positions) == 0:
+        return bars
+
+    gaps_error = CandlesGapError(candles_size=candles_size, symbol=symbol,
+                                 gaps_timestamps=bars["timestamp"][positions - 1].tolist(), missing_candles=missing_candles.tolist())
+
+    if gaps == "raise":
+        raise gaps_error
+
+    # the exercise is kept, but we still report where the holes are
+    # (in a new line, because the progress bar of get_exercises doesn't end its line)
+    action = "filling" if gaps == "fill" else "skipping"
+    print(f"\n[WARNING] {action} gaps: {gaps_error}")
+
+    if gaps == "fill":
+        return fill_gaps(bars, candles_size, candles_amount)
+
+    return bars
 
 
 def trending(closings: np.array):
@@ -118,9 +275,10 @@ def trending(closings: np.array):
     return 1 * (standarized_slope >= 0.5) + -1 * (standarized_slope <= -0.5), regression
 
 
-def get_exercises(exercises_amount: int, candles_amount: int = 512, candles_size: str = "15m"):
+def get_exercises(exercises_amount: int, candles_amount: int = 512, candles_size: str = "15m", gaps: str = "raise"):
     """
-    Generates exercises retrieving candles from Binance API to predict the tendence
+    Generates exercises retrieving candles from Binance API to predict the tendence.
+    Missing candles are treated according to gaps (see gaps_policies)
     """
 
     # gets all available symbols from Binance
@@ -174,25 +332,26 @@ def get_exercises(exercises_amount: int, candles_amount: int = 512, candles_size
 
             # retrieved bars from Binance API
             bars = get_candles(symbol=symbol, start=start,
-                               candles_amount=candles_amount, candles_size=candles_size)
-            bars = np.array(bars).astype(float)
-            closings = bars[:, 4]
-
-            # consider the following indexes
-            # bars[i][1] = open
-            # bars[i][2] = high
-            # bars[i][3] = low
-            # bars[i][4] = close
-            # bars[i][5] = volume
+                               candles_amount=candles_amount, candles_size=candles_size, gaps=gaps)
+            closings = bars["close"]
+
+            # consider the following fields
+            # bars[i]["timestamp"] = timestamp
+            # bars[i]["open"] = open
+            # bars[i]["high"] = high
+            # bars[i]["low"] = low
+            # bars[i]["close"] = close
+            # bars[i]["volume"] = volume
             # with that, we flatten the data and order will keep
             # but with the following indexes
-            # x_training[i][j][0] = open
-            # x_training[i][j][1] = high
-            # x_training[i][j][2] = low
-            # x_training[i][j][3] = close
-            # x_training[i][j][4] = volume
+            # x_training[i][j][0] = timestamp
+            # x_training[i][j][1] = open
+            # x_training[i][j][2] = high
+            # x_training[i][j][3] = low
+            # x_training[i][j][4] = close
+            # x_training[i][j][5] = volume
             trend, _ = trending(closings)
-            x_training.append(bars[:,:6])
+            x_training.append(structured_to_unstructured(bars, dtype=float))
             y_training.append(trend)
 
             # clear the output to print in the same line
@@ -205,14 +364,16 @@ def get_exercises(exercises_amount: int, candles_amount: int = 512, candles_size
         except NotEnoughCandlesFromBinanceError:
             print(
                 f"[ERROR] candle size: {candles_size} candles_amount: {candles_amount} symbol: {symbol} start: {start}")
+        except CandlesGapError as e:
+            print(f"[ERROR] {e}")
 
     return x_training, y_training
 
 
-def build_exercises(exercises_amount, candles_amount):
+def build_exercises(exercises_amount, candles_amount, gaps="raise"):
     # gets training data
     x_training, y_training = get_exercises(
-        exercises_amount=exercises_amount, candles_amount=candles_amount)
+        exercises_amount=exercises_amount, candles_amount=candles_amount, gaps=gaps)
 
     # persist data into pickles
     with open("training/x_training.pickle", "wb") as f:
@@ -2,13 +2,16 @@ from flask import Flask
 from flask import request
 from flask_cors import CORS
 from dementor import Dementor
+from dementor import ClosingsEncoder
 
 import numpy as np
+import glob
 import pickle
 import binance_client_setup
 import cryptocurrencies_setup
 import exercises_builder
 import os
+import time
 
 # the number of local exercise to train
 exercises_amount = 3
@@ -22,6 +25,23 @@ total_candles = 1000
 # or well-known as OHLCV
 total_indicators = 6
 
+# when enabled, a shared encoder turns the closings of every exercise
+# into an embedding (computed once per exercise_hash and cached),
+# then every user only trains a lightweight head over those embeddings
+# otherwise, every user trains a whole model over the closings
+shared_encoder = False
+
+# the size of the embeddings given by the shared encoder
+# (only used when training it from scratch, otherwise the size is taken from the trained encoder)
+embedding_shape = 32
+
+# the shared encoder is trained again (over the current exercises) on startup
+# when it's older than this number of days, or well,
+# when the environment variable "retrain_encoder" is set to "1"
+# every retraining changes the embeddings, so heads of the previous encoder are discarded
+# and the next answer of every user builds a new head trained over their historic answers
+encoder_retraining_days = 7
+
 # initializes the binance client to make request to the Binance API
 # the client indeed is a global variable named "client"
 binance_client_setup.initialize_binance_client()
@@ -69,6 +89,68 @@ with open("training/y_training.pickle", "rb") as f:
     # this will be removed in the future
     y_training += 1
 
+# trains the shared encoder (if it isn't trained yet or it's time to train it again)
+# and computes the embedding of every exercise, where exercises_embeddings[exercise_hash]
+# is the embedding of the exercise, those are cached into "training/embeddings.pickle"
+if shared_encoder:
+    exercises_closings = x_training[:, :, ohlcv_to_index["close"]]
+    encoder_path = "models/encoder.h5"
+
+    retrain_encoder = not os.path.exists(encoder_path) or \
+        os.environ.get("retrain_encoder") == "1" or \
+        time.time() - os.path.getmtime(encoder_path) > encoder_retraining_days * 24 * 60 * 60
+
+    if retrain_encoder:
+        encoder = ClosingsEncoder(
+            closings_shape=total_candles, embedding_shape=embedding_shape)
+        encoder.train(exercises_closings)
+        encoder.save_model()
+    else:
+        encoder = ClosingsEncoder(encoder_path)
+
+    # the trained encoder could give embeddings of other size than the configured one
+    embedding_shape = encoder.embedding_shape()
+
+    # heads are tied to the encoder they were trained with,
+    # once the encoder is trained again, users get new heads
+    encoder_fingerprint = encoder.fingerprint()[:12]
+
+    exercises_embeddings = encoder.embeddings(
+        exercises_closings, "training/embeddings.pickle")
+
+
+def exercises_inputs(exercise_hashes):
+    """
+    Gets the inputs of the user model for the given exercises,
+    i.e, their closings or their embeddings (when using the shared encoder)
+    """
+    if shared_encoder:
+        return exercises_embeddings[exercise_hashes].reshape(-1, embedding_shape)
+
+    return x_training[exercise_hashes, :, ohlcv_to_index["close"]].reshape(-1, total_candles, used_indicators)
+
+
+def historic_dataset(user_stats):
+    """
+    Gets the inputs and outputs of the user model for every exercise answered by the user
+    """
+    exercise_hashes_and_user_trending_responses = np.array(
+        user_stats["exercise_hashes_and_user_trending_responses"])
+
+    historic_exercises_hashes = np.array(
+        exercise_hashes_and_user_trending_responses[:, 0])
+    historic_user_trending_responses = np.array(
+        exercise_hashes_and_user_trending_responses[:, 1])
+
+    historic_user_trending_responses_one_hot_encoded = np.eye(total_trendings)[
+        historic_user_trending_responses].reshape(-1, total_trendings)
+    historic_exercises_trendings = y_training[historic_exercises_hashes].reshape(
+        -1, 1)
+    historic_exercises_candles = exercises_inputs(
+        historic_exercises_hashes)
+
+    return [historic_exercises_trendings, historic_exercises_candles], historic_user_trending_responses_one_hot_encoded
+
 
 @app.route("/exercise")
 def exercise():
@@ -104,10 +186,35 @@ def respond():
                 request.form["user_trending_response"])
             exercise_hash = int(request.form["exercise_hash"])
 
-        model_path = f"models/{user_hash}.h5"
+        # per-user heads are stored apart from the whole per-user models
+        # this way, both kind of models can live together
+        # also, heads include the encoder fingerprint, then heads trained over
+        # the embeddings of another encoder are not loaded (a new one is built instead)
+        model_name = f"{user_hash}_head_{encoder_fingerprint}" if shared_encoder else user_hash
+        model_path = f"models/{model_name}.h5"
+
+        user_stats = {"matches": 0, "attempts": 0,
+                      "exercise_hashes_and_user_trending_responses": []}
+
+        try:
+            with open(f"stats/{user_hash}.pickle", "rb") as f:
+                user_stats = pickle.load(f)
+        except FileNotFoundError:
+            pass
 
         if os.path.exists(model_path):
-            dementor = Dementor(f"models/{user_hash}.h5")
+            dementor = Dementor(model_path)
+        elif shared_encoder:
+            dementor = Dementor(embedding_shape=embedding_shape)
+
+            # heads of previous encoders are useless from now on
+            for stale_model_path in glob.glob(f"models/{glob.escape(user_hash)}_head_*.h5"):
+                os.remove(stale_model_path)
+
+            # the new head learns the historic answers of the user (if any)
+            # this way, the user doesn't start over when the encoder is trained again
+            if user_stats["exercise_hashes_and_user_trending_responses"]:
+                dementor.fit(*historic_dataset(user_stats))
         else:
             dementor = Dementor()
 
@@ -116,20 +223,10 @@ def respond():
         user_trending_response_one_hot_encoded = np.eye(
             total_trendings)[user_trending_response_reshaped].reshape(-1, total_trendings)
         exercise_trending = y_training[exercise_hash].reshape(-1, 1)
-        exercise_candles = x_training[exercise_hash, :, ohlcv_to_index["close"]].reshape(
-            -1, total_candles, used_indicators)
+        exercise_candles = exercises_inputs(exercise_hash)
         training_feedback = dementor.train_on_batch(
             inputs=[exercise_trending, exercise_candles], outputs=user_trending_response_one_hot_encoded)
-        dementor.save_model(user_hash)
-
-        user_stats = {"matches": 0, "attempts": 0,
-                      "exercise_hashes_and_user_trending_responses": []}
-
-        try:
-            with open(f"stats/{user_hash}.pickle", "rb") as f:
-                user_stats = pickle.load(f)
-        except FileNotFoundError:
-            pass
+        dementor.save_model(model_name)
 
         user_stats["matches"] += int(training_feedback["accuracy"])
         user_stats["attempts"] += 1
@@ -139,23 +236,7 @@ def respond():
         with open(f"stats/{user_hash}.pickle", "wb") as f:
             pickle.dump(user_stats, f)
 
-        exercise_hashes_and_user_trending_responses = np.array(
-            user_stats["exercise_hashes_and_user_trending_responses"])
-
-        historic_exercises_hashes = np.array(
-            exercise_hashes_and_user_trending_responses[:, 0])
-        historic_user_trending_responses = np.array(
-            exercise_hashes_and_user_trending_responses[:, 1])
-
-        historic_user_trending_responses_one_hot_encoded = np.eye(total_trendings)[
-            historic_user_trending_responses].reshape(-1, total_trendings)
-        historic_exercises_trendings = y_training[historic_exercises_hashes].reshape(
-            -1, 1)
-        historic_exercises_candles = x_training[historic_exercises_hashes, :,
-                                                ohlcv_to_index["close"]].reshape(-1, total_candles, used_indicators)
-
-        evaluation_feedback = dementor.evaluate(
-            [historic_exercises_trendings, historic_exercises_candles], historic_user_trending_responses_one_hot_encoded)
+        evaluation_feedback = dementor.evaluate(*historic_dataset(user_stats))
 
         print("ehash:", y_training[exercise_hash, 0], "user:", user_trending_response)
         response = {